@@ -1,139 +1,408 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import google.generativeai as genai
-import time
+from fastapi import FastAPI, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import aiohttp
+import asyncio
+import orjson
+import itertools
 import hashlib
 import os
-import threading
-from queue import PriorityQueue, Empty
 
-app = Flask(__name__)
-CORS(app)
+try:
+    from blake3 import blake3
+except ImportError:  # No wheel for this platform; fall back to the stdlib
+    blake3 = None
 
 # --- CONFIGURATION ---
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
+REDIS_URL = os.environ.get("REDIS_URL")  # Optional shared cache across workers
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:streamGenerateContent?alt=sse"
+
+MAX_QUEUE_SIZE = 20  # Queued (not yet running) calls before answering 503
+MAX_CONCURRENCY = 8  # Gemini calls in flight at once (one per worker)
+MAX_STREAMS = 8  # Concurrent /analyze/stream calls before answering 503
+GEMINI_RPM = 60  # Requests per minute allowed by the API quota
+RATE_LIMIT_BACKOFF = 10  # Seconds all workers pause after a 429
+CACHE_SIZE = 2048  # Responses kept in memory (LRU-evicted beyond this)
+CACHE_TTL = 3600  # Seconds before a cached response expires
+CACHE_PREFIX = "prooflens:v2:"  # Namespace for keys in the shared Redis cache
+REDIS_TIMEOUT = 2  # Seconds before a stalled Redis call counts as a miss
+REQUEST_TIMEOUT = 115  # Seconds; generous to absorb backoff delays
+
+# --- GEMINI CLIENT ---
+# Shared pooled session (created on startup): keep-alive connections let
+# successive calls skip the TCP + TLS handshake.
+http_session = None
+# Streams hold a connection for the whole generation, so they get their own
+# pool and can never starve the queue workers of connections
+stream_session = None
+
+class GeminiAPIError(Exception):
+    """Non-200 reply from the Gemini REST API"""
+    def __init__(self, status, message):
+        super().__init__(f"{status} {message}")
+        self.status = status
+
+async def api_error(resp):
+    """Build a GeminiAPIError from a non-200 reply"""
+    try:
+        message = orjson.loads(await resp.read())['error']['message']
+    except (ValueError, KeyError, TypeError):
+        message = resp.reason
+    return GeminiAPIError(resp.status, message)
+
+async def call_gemini(prompt):
+    """Send one prompt to Gemini and return the generated text"""
+    # orjson encodes the prompt straight to UTF-8 bytes in one pass
+    body = orjson.dumps({"contents": [{"parts": [{"text": prompt}]}]})
+    async with http_session.post(GEMINI_URL, data=body) as resp:
+        if resp.status != 200:
+            raise await api_error(resp)
+        data = orjson.loads(await resp.read())
+
+    try:
+        return data['candidates'][0]['content']['parts'][0]['text']
+    except (KeyError, IndexError):
+        reason = data.get('promptFeedback', {}).get('blockReason', "no candidates returned")
+        raise GeminiAPIError(resp.status, f"Empty response ({reason})")
+
+async def stream_gemini(prompt):
+    """Send one prompt to Gemini and yield the text as it is generated"""
+    body = orjson.dumps({"contents": [{"parts": [{"text": prompt}]}]})
+    async with stream_session.post(GEMINI_STREAM_URL, data=body) as resp:
+        if resp.status != 200:
+            raise await api_error(resp)
+        # Server-sent events: one "data: {json}" line per chunk
+        async for line in resp.content:
+            if not line.startswith(b"data:"):
+                continue
+            chunk = orjson.loads(line[5:])
+            for candidate in chunk.get('candidates', [])[:1]:
+                for part in candidate.get('content', {}).get('parts', []):
+                    if part.get('text'):
+                        yield part['text']
 
 # --- MEMORY SYSTEMS ---
-response_cache = {}
-# Priority Queue: (priority_number, timestamp, task_dict)
+def hash_prompt(data):
+    """128-bit cache key for an encoded prompt"""
+    if blake3 is not None:
+        # SIMD-accelerated; far faster than md5 on long essays
+        return blake3(data).hexdigest(length=16)
+    # blake2b is built into CPython and, unlike md5, allowed on FIPS builds
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# Both levels hold the finished JSON body of a cache-hit response.
+# L1: per-process, bounded so unique prompts can't grow memory forever.
+# Only touched from the event loop thread, so no lock is needed.
+response_cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+# L2: Redis shared by every worker process (created on startup if configured)
+redis_client = None
+# Background Redis writes, referenced so they aren't garbage collected
+redis_writes = set()
+# Priority Queue: (priority_number, sequence_number, Task)
 # Priority 1 = High (Grammar, etc.), Priority 5 = Low (Plagiarism chunks)
-request_queue = PriorityQueue()
-last_request_time = 0
-current_delay = 0  # Start with 0 delay (Optimistic)
-
-def process_queue():
-    """Smart background worker with adaptive rate limiting"""
-    global last_request_time, current_delay
-    
+# Created on startup so it binds to the server's event loop
+request_queue = None
+# FIFO tie-breaker within a priority: never steps backwards or repeats,
+# so the queue never falls through to comparing Task objects
+queue_order = itertools.count()
+# In-flight tasks by prompt hash, so identical concurrent prompts share one
+# Gemini call. Check-and-insert happens without an await in between, which
+# makes it atomic on the event loop.
+pending = {}
+# Token bucket shared by all workers: up to GEMINI_RPM calls per minute
+# (split evenly between server processes), with bursts allowed instead of
+# a fixed gap between calls. Created on startup, once the process count
+# is final.
+rate_limiter = None
+# Cleared for RATE_LIMIT_BACKOFF seconds after a 429 so every worker pauses
+# together, instead of each racing the others into another 429
+api_ready = None
+# Streams currently holding a slot (bounded by MAX_STREAMS)
+open_streams = 0
+
+async def cache_get(prompt_hash):
+    """Look up a cache-hit response body in L1, then Redis; None on a miss"""
+    body = response_cache.get(prompt_hash)
+    if body is not None or redis_client is None:
+        return body
+
+    try:
+        # GETEX refreshes the TTL so hot prompts stay cached
+        body = await redis_client.getex(CACHE_PREFIX + prompt_hash, ex=CACHE_TTL)
+    except RedisError as e:
+        print(f"Cache Error: {e}")
+        return None
+
+    if body is not None:
+        response_cache[prompt_hash] = body
+    return body
+
+def cache_set(prompt_hash, text):
+    """Store a response in L1 now and in Redis in the background"""
+    # Serialized once here so every hit is a plain bytes write
+    body = orjson.dumps({"result": text, "cached": True})
+    response_cache[prompt_hash] = body
+    if redis_client is None:
+        return
+
+    # Callers never wait on Redis: a slow write mustn't hold back a reply
+    write = asyncio.create_task(redis_set(prompt_hash, body))
+    redis_writes.add(write)
+    write.add_done_callback(redis_writes.discard)
+
+async def redis_set(prompt_hash, body):
+    """Write a response body through to Redis"""
+    try:
+        await redis_client.set(CACHE_PREFIX + prompt_hash, body, ex=CACHE_TTL)
+    except RedisError as e:
+        print(f"Cache Error: {e}")
+
+@dataclass(slots=True)
+class Task:
+    """One queued Gemini call, shared by every request waiting on it"""
+    prompt: str
+    hash: str
+    future: asyncio.Future  # Resolves to the reply text or the API error
+
+class AnalyzeRequest(BaseModel):
+    prompt: str
+    priority: int = 5  # Default to Low priority (5)
+
+def server_processes():
+    """Number of server processes sharing the Gemini quota"""
+    # gunicorn.conf.py exports the real worker count; plain uvicorn is one
+    count = int(os.environ.get("WEB_CONCURRENCY", 1))
+    if count < 1:
+        raise RuntimeError(f"WEB_CONCURRENCY must be at least 1, got {count}")
+    return count
+
+def start_cooldown():
+    """Pause every Gemini caller for RATE_LIMIT_BACKOFF seconds after a 429"""
+    if api_ready.is_set():
+        print("Rate limit hit. Engaging backoff.")
+        api_ready.clear()
+        asyncio.get_running_loop().call_later(RATE_LIMIT_BACKOFF, api_ready.set)
+
+async def process_queue():
+    """Background worker; several run concurrently, sharing the rate limiter"""
     while True:
         try:
-            # Get next task (blocks for 0.1s to avoid CPU spin)
+            # Suspends until a task arrives (no polling)
             # PriorityQueue returns lowest number first
-            priority, _, task = request_queue.get(timeout=0.1)
-            
-            # Rate Limit Governor (Adaptive)
-            now = time.time()
-            elapsed = now - last_request_time
-            if elapsed < current_delay:
-                time.sleep(current_delay - elapsed)
+            priority, _, task = await request_queue.get()
 
             try:
-                model = genai.GenerativeModel('gemini-2.5-flash')
-                if not task['prompt']:
-                    task['error'] = "Empty prompt"
-                else:
-                    response = model.generate_content(task['prompt'])
-                    response_cache[task['hash']] = response.text
-                    task['result'] = response.text
-                
-                # Success! Slowly reduce delay to speed up
-                current_delay = max(0, current_delay * 0.8)
-                
+                if not task.prompt:
+                    raise ValueError("Empty prompt")
+                await api_ready.wait()
+                async with rate_limiter:
+                    text = await call_gemini(task.prompt)
+                cache_set(task.hash, text)
+
             except Exception as e:
-                err_str = str(e)
-                print(f"API Error: {err_str}")
-                
+                print(f"API Error: {e}")
+
                 # Handle 429 Rate Limit specifically
-                if "429" in err_str:
-                    print("Rate limit hit. Engaging backoff.")
-                    # drastic backoff
-                    current_delay = 10.0 
-                    # Re-queue the failed task with same priority
-                    # We create a new event so the original waiter doesn't timeout if we can avoid it,
-                    # but simplest is just to put it back.
-                    # Ideally we sleep here to let API cool down
-                    time.sleep(10) 
-                    request_queue.put((priority, time.time(), task))
-                    continue # Skip marking as done
-                else:
-                    task['error'] = err_str
-            
-            finally:
-                last_request_time = time.time()
-                # Only signal if we didn't re-queue
-                if task.get('result') or task.get('error'):
-                    task['event'].set()
-                
-        except Empty:
-            continue
+                if isinstance(e, GeminiAPIError) and e.status == 429:
+                    start_cooldown()
+                    # Re-queue the failed task with same priority; it runs
+                    # again once the shared cooldown ends. If the queue
+                    # filled up meanwhile, the 429 goes back to the client.
+                    try:
+                        request_queue.put_nowait((priority, next(queue_order), task))
+                        continue # Skip resolving the future
+                    except asyncio.QueueFull:
+                        pass
+                task.future.set_exception(e)
+            else:
+                task.future.set_result(text)
+
+            pending.pop(task.hash, None)
+
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             print(f"Worker Error: {e}")
 
-# Start background thread
-worker_thread = threading.Thread(target=process_queue, daemon=True)
-worker_thread.start()
-
-@app.route('/', methods=['GET'])
-def home():
-    return "ProofLens Backend is Active (Priority Queue Enabled)!", 200
-
-@app.route('/analyze', methods=['POST'])
-def analyze():
-    data = request.json
-    if not data or 'prompt' not in data:
-        return jsonify({"error": "No prompt provided"}), 400
-    
-    prompt = data.get('prompt', '')
-    priority = data.get('priority', 5) # Default to Low priority (5)
-    
+@asynccontextmanager
+async def lifespan(app):
+    """Create the shared clients and workers, and tear them down in order"""
+    global http_session, stream_session, redis_client, request_queue, api_ready, rate_limiter
+    # The API key rides along as a default header, built once here rather
+    # than per call (and kept out of URLs that end up in error messages)
+    headers = {"x-goog-api-key": GOOGLE_API_KEY or "", "Content-Type": "application/json"}
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75),
+        headers=headers,
+    )
+    stream_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=MAX_STREAMS, keepalive_timeout=75),
+        headers=headers,
+    )
+    if REDIS_URL:
+        # Timeouts turn an unreachable Redis into RedisError (a cache miss)
+        # instead of a hang until the OS gives up on the socket
+        redis_client = Redis.from_url(
+            REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+        )
+    request_queue = asyncio.PriorityQueue(maxsize=MAX_QUEUE_SIZE)
+    rate_limiter = AsyncLimiter(max_rate=GEMINI_RPM / server_processes(), time_period=60)
+    api_ready = asyncio.Event()
+    api_ready.set()
+    workers = [asyncio.create_task(process_queue()) for _ in range(MAX_CONCURRENCY)]
+
+    yield
+
+    # Workers park in request_queue.get() with no timeout, so they use no
+    # CPU while idle; cancellation is the sentinel that wakes them to exit.
+    # They must be stopped before the clients close, since a worker may be
+    # mid-call on the session or Redis.
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    await http_session.close()
+    await stream_session.close()
+    if redis_client is not None:
+        # Let in-flight writes finish (bounded by REDIS_TIMEOUT) first
+        await asyncio.gather(*redis_writes, return_exceptions=True)
+        await redis_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+def json_response(obj, status_code=200):
+    """JSON response encoded with orjson, several times faster than stdlib json"""
+    return Response(orjson.dumps(obj), media_type='application/json', status_code=status_code)
+
+@app.exception_handler(RequestValidationError)
+async def invalid_request(request: Request, exc: RequestValidationError):
+    return json_response({"error": "No prompt provided"}, status_code=400)
+
+@app.get('/', response_class=PlainTextResponse)
+async def home():
+    return "ProofLens Backend is Active (Priority Queue Enabled)!"
+
+@app.post('/analyze')
+async def analyze(data: AnalyzeRequest):
+    prompt = data.prompt
+    priority = data.priority
+
     # 1. Check Cache
-    prompt_hash = hashlib.md5(prompt.encode()).hexdigest()
-    if prompt_hash in response_cache:
-        return jsonify({"result": response_cache[prompt_hash], "cached": True})
-
-    # 2. Queue Management (Fail fast if overloaded)
-    if request_queue.qsize() >= 20:
-        return jsonify({"error": "Server busy. Try again in a few seconds."}), 503
-
-    # 3. Add to Priority Queue
-    event = threading.Event()
-    task = { 
-        'prompt': prompt, 
-        'hash': prompt_hash, 
-        'event': event, 
-        'result': None, 
-        'error': None 
-    }
-    
-    # Use time.time() as tie-breaker for FIFO within same priority
-    request_queue.put((priority, time.time(), task))
-    
-    # 4. Wait
-    # Increased timeout to handle backoff delays
-    is_done = event.wait(timeout=115)
-    
-    if not is_done:
-        return jsonify({"error": "Request timed out (Queue too slow)."}), 504
-        
-    if task['error']:
+    prompt_hash = hash_prompt(prompt.encode())
+    cached = await cache_get(prompt_hash)
+    if cached is not None:
+        return Response(cached, media_type='application/json')
+
+    # 2. Join an identical request that is already in flight
+    task = pending.get(prompt_hash)
+    if task is None:
+        # 3. Add to Priority Queue (the bounded queue fails fast if overloaded)
+        task = Task(prompt, prompt_hash, asyncio.get_running_loop().create_future())
+        # Mark the error as retrieved even if every waiter already timed out;
+        # the worker has printed it, so asyncio needn't log it again
+        task.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            request_queue.put_nowait((priority, next(queue_order), task))
+        except asyncio.QueueFull:
+            return json_response({"error": "Server busy. Try again in a few seconds."}, status_code=503)
+        pending[prompt_hash] = task
+
+    # 4. Wait (a suspended coroutine, not a blocked thread). shield() keeps
+    # a timeout here from cancelling the future other requests share.
+    try:
+        text = await asyncio.wait_for(asyncio.shield(task.future), timeout=REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        return json_response({"error": "Request timed out (Queue too slow)."}, status_code=504)
+    except Exception as e:
         status_code = 500
-        if "429" in task['error']: status_code = 429
-        return jsonify({"error": task['error']}), status_code
-        
-    return jsonify({"result": task['result'], "cached": False})
+        if isinstance(e, GeminiAPIError) and e.status == 429: status_code = 429
+        return json_response({"error": str(e)}, status_code=status_code)
+
+    return json_response({"result": text, "cached": False})
+
+@app.post('/analyze/stream')
+async def analyze_stream(data: AnalyzeRequest):
+    """Stream the reply as server-sent events while Gemini generates it.
+
+    Each text chunk is sent as a JSON-encoded string in a `data:` line,
+    followed by an `event: done` (or `event: error`) message. Streams
+    skip the priority queue but share the cache, rate limiter and 429
+    cooldown with /analyze; at most MAX_STREAMS run at once.
+    """
+    prompt = data.prompt
+    prompt_hash = hash_prompt(prompt.encode())
+    cached = await cache_get(prompt_hash)
+
+    # Fail fast if overloaded (cache hits don't need a slot)
+    if cached is None and open_streams >= MAX_STREAMS:
+        return json_response({"error": "Server busy. Try again in a few seconds."}, status_code=503)
+
+    async def events():
+        global open_streams
+        if cached is not None:
+            yield b"data: " + orjson.dumps(orjson.loads(cached)['result']) + b"\n\n"
+            yield b'event: done\ndata: {"cached": true}\n\n'
+            return
+
+        # The slot is taken here rather than in the route so the finally
+        # below always releases it; a stream that lost the race since the
+        # check above gets an error event instead of a 503
+        if open_streams >= MAX_STREAMS:
+            yield b'event: error\ndata: "Server busy. Try again in a few seconds."\n\n'
+            return
+        open_streams += 1
+
+        upstream = stream_gemini(prompt)
+        chunks = []
+        try:
+            if not prompt:
+                raise ValueError("Empty prompt")
+            # Waiting for the cooldown, a limiter token and the first chunk
+            # share one deadline, like a queued /analyze request
+            try:
+                async with asyncio.timeout(REQUEST_TIMEOUT):
+                    await api_ready.wait()
+                    await rate_limiter.acquire()
+                    text = await anext(upstream, None)
+            except TimeoutError:
+                raise TimeoutError("Request timed out (Queue too slow).")
+
+            while text is not None:
+                chunks.append(text)
+                yield b"data: " + orjson.dumps(text) + b"\n\n"
+                text = await anext(upstream, None)
+        except Exception as e:
+            print(f"API Error: {e}")
+            if isinstance(e, GeminiAPIError) and e.status == 429:
+                start_cooldown()
+            yield b"event: error\ndata: " + orjson.dumps(str(e)) + b"\n\n"
+            return
+        finally:
+            open_streams -= 1
+            # Releases the pooled connection if the client left mid-stream
+            await upstream.aclose()
+
+        # Only complete replies are cached; a client that disconnects
+        # mid-stream closes this generator before reaching here
+        if chunks:
+            cache_set(prompt_hash, "".join(chunks))
+        yield b'event: done\ndata: {"cached": false}\n\n'
+
+    return StreamingResponse(events(), media_type='text/event-stream')
 
 if __name__ == '__main__':
+    import uvicorn
     port = int(os.environ.get("PORT", 10000))
-    app.run(host='0.0.0.0', port=port)
+    # A single process multiplexes every pending request on one event loop
+    uvicorn.run(app, host='0.0.0.0', port=port)
@@ -0,0 +1,17 @@
+# Production server: `gunicorn app:app` picks this file up automatically.
+# Each process runs an asyncio event loop (via Uvicorn), so one worker
+# multiplexes thousands of requests waiting on Gemini instead of one per
+# thread.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+worker_class = "uvicorn_worker.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+def on_starting(server):
+    # The final count includes any -w/--workers override. app.py splits the
+    # Gemini quota by it, so export the real value before workers fork.
+    count = server.cfg.workers
+    if count < 1:
+        raise RuntimeError(f"Gunicorn needs at least 1 worker, got {count}")
+    os.environ["WEB_CONCURRENCY"] = str(count)